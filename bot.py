@@ -5,8 +5,11 @@ import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
 from typing import Optional
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 load_dotenv()
 
@@ -15,6 +18,10 @@ GUILD_ID = os.getenv('GUILD_ID')
 
 # Configuration - The role name that identifies mafia players
 PLAYER_ROLE_NAME = os.getenv('PLAYER_ROLE_NAME', 'i play mafia')
+PLAYER_ROLE_NAME_LOWER = PLAYER_ROLE_NAME.lower()
+
+# Cache of guild_id -> player role id, invalidated by role update/delete events
+_role_cache: dict[int, int] = {}
 
 # Optional: Limit bot to specific category (set in .env or leave empty for all categories)
 ALLOWED_CATEGORY_ID = os.getenv('ALLOWED_CATEGORY_ID')
@@ -24,18 +31,37 @@ ALLOWED_CATEGORY_ID = os.getenv('ALLOWED_CATEGORY_ID')
 HAMMER_DURATION = timedelta(hours=24) 
 # HAMMER_DURATION = timedelta(seconds=60) # TESTING MODE
 
+# How often a tally update is posted while the hammer is running
+HAMMER_UPDATE_INTERVAL = timedelta(hours=4)
+
 # Bot setup with required intents
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+class MafiaBot(commands.Bot):
+    async def close(self):
+        """Close the database connection along with the Discord session."""
+        try:
+            await db.flush_votes()
+            db.close()
+        finally:
+            await super().close()
+
+
+bot = MafiaBot(command_prefix='!', intents=intents)
 
 
 def get_player_role(guild: discord.Guild) -> Optional[discord.Role]:
     """Get the mafia player role from the guild."""
+    role_id = _role_cache.get(guild.id)
+    if role_id is not None:
+        role = guild.get_role(role_id)
+        if role:
+            return role
     for role in guild.roles:
-        if role.name.lower() == PLAYER_ROLE_NAME.lower():
+        if role.name.lower() == PLAYER_ROLE_NAME_LOWER:
+            _role_cache[guild.id] = role.id
             return role
     return None
 
@@ -61,7 +87,8 @@ def has_player_role(member: discord.Member) -> bool:
     """Check if a member has the mafia player role."""
     role = get_player_role(member.guild)
     if role:
-        return role in member.roles
+        # Member.get_role checks the member's sorted role-id list instead of scanning member.roles
+        return member.get_role(role.id) is not None
     return False
 
 
@@ -73,103 +100,67 @@ def get_players_with_role(guild: discord.Guild) -> list[discord.Member]:
     return []
 
 
-class GameState:
-    """Tracks the state of a Mafia game in a specific channel."""
-    
-    def __init__(self):
-        self.votes: dict[int, int] = {}  # voter_id -> target_id
-        self.hammer_active: bool = False
-        self.hammer_end_time: Optional[datetime] = None
-        self.game_channel: Optional[discord.TextChannel] = None
-        self.last_update_time: Optional[datetime] = None
-        self.eliminated_players: set[int] = set()  # Players who have been eliminated
-        self.game_active: bool = False
-    
-    def get_active_players(self, guild: discord.Guild) -> list[discord.Member]:
-        """Get all active players (have role and not eliminated)."""
-        all_players = get_players_with_role(guild)
-        return [p for p in all_players if p.id not in self.eliminated_players]
-    
-    def eliminate_player(self, member: discord.Member):
-        """Mark a player as eliminated."""
-        self.eliminated_players.add(member.id)
-        # Remove any votes to/from this player
-        self.votes = {k: v for k, v in self.votes.items() 
-                     if k != member.id and v != member.id}
-    
-    def cast_vote(self, voter_id: int, target_id: int) -> bool:
-        """Cast a vote. Returns True if successful."""
-        self.votes[voter_id] = target_id
-        return True
-    
-    def remove_vote(self, voter_id: int) -> bool:
-        """Remove a vote. Returns True if a vote was removed."""
-        if voter_id in self.votes:
-            del self.votes[voter_id]
-            return True
-        return False
-    
-    def get_vote_tally(self) -> dict[int, list[int]]:
-        """Get current vote tally. Returns {target_id: [voter_ids]}"""
-        tally = defaultdict(list)
-        for voter_id, target_id in self.votes.items():
-            tally[target_id].append(voter_id)
-        return dict(tally)
-    
-    def get_majority_threshold(self, guild: discord.Guild) -> int:
-        """Get the number of votes needed for majority."""
-        active_players = self.get_active_players(guild)
-        return (len(active_players) // 2) + 1
-    
-    def check_majority(self, guild: discord.Guild) -> Optional[int]:
-        """Check if any player has majority votes. Returns player_id or None."""
-        threshold = self.get_majority_threshold(guild)
-        tally = self.get_vote_tally()
-        for target_id, voters in tally.items():
-            if len(voters) >= threshold:
-                return target_id
-        return None
-    
-    def start_hammer(self, channel: discord.TextChannel):
-        """Start the 24-hour hammer countdown."""
-        self.hammer_active = True
-        self.hammer_end_time = datetime.now() + timedelta(hours=24)
-        self.game_channel = channel
-        self.last_update_time = datetime.now()
-    
-    def get_time_remaining(self) -> Optional[timedelta]:
-        """Get time remaining in hammer countdown."""
-        if not self.hammer_active or not self.hammer_end_time:
-            return None
-        remaining = self.hammer_end_time - datetime.now()
-        if remaining.total_seconds() < 0:
-            return timedelta(0)
-        return remaining
-    
-    def is_hammer_expired(self) -> bool:
-        """Check if the hammer countdown has expired."""
-        remaining = self.get_time_remaining()
-        return remaining is not None and remaining.total_seconds() <= 0
-
-
 # ... (imports remain)
 import sqlite3
 
 # ... (Configuration remains)
 
+# Seconds to hold buffered vote changes before writing them in one transaction
+VOTE_FLUSH_DELAY = 0.5
+
 class Database:
     def __init__(self, db_name='mafia.db'):
         self.db_name = db_name
+        # One long-lived connection shared by every call; the lock serializes access
+        self.conn = sqlite3.connect(self.db_name, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._closed = False
+        # Write-behind vote buffer: (guild_id, voter_id) -> target_id, or None for a removal
+        self.pending_votes: dict[tuple[int, int], Optional[int]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Strong reference so the scheduled flush task isn't garbage-collected mid-run
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None  # See _get_flush_lock
         self.init_db()
 
-    def get_connection(self):
-        return sqlite3.connect(self.db_name)
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                # Refresh planner statistics for the per-guild lookups before shutting down
+                self.conn.execute('PRAGMA optimize')
+            finally:
+                self.conn.close()
+
+    @contextmanager
+    def _transaction(self, mode: str = ''):
+        """Hold the lock and run the enclosed statements as one transaction."""
+        with self._lock:
+            self.conn.execute(f'BEGIN {mode}')
+            try:
+                yield
+                self.conn.execute('COMMIT')
+            except BaseException:
+                # Covers a failed COMMIT too (e.g. SQLITE_BUSY), which leaves the transaction open
+                if self.conn.in_transaction:
+                    try:
+                        self.conn.execute('ROLLBACK')
+                    except sqlite3.Error as e:
+                        print(f"Rollback error: {e}")
+                raise
 
     def init_db(self):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        with self._lock:
+            # WAL + NORMAL sync: one WAL append per commit instead of two fsyncs
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('PRAGMA temp_store=MEMORY')
+            self.conn.execute('PRAGMA cache_size=-64000')
+            self.conn.execute('PRAGMA busy_timeout=5000')
             # Games table
-            cursor.execute('''
+            self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS games (
                     guild_id INTEGER PRIMARY KEY,
                     channel_id INTEGER,
@@ -180,7 +171,7 @@ class Database:
                 )
             ''')
             # Votes table
-            cursor.execute('''
+            self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS votes (
                     guild_id INTEGER,
                     voter_id INTEGER,
@@ -189,19 +180,17 @@ class Database:
                 )
             ''')
             # Eliminated players table
-            cursor.execute('''
+            self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS eliminated (
                     guild_id INTEGER,
                     player_id INTEGER,
                     PRIMARY KEY (guild_id, player_id)
                 )
             ''')
-            conn.commit()
 
     def save_game(self, guild_id: int, game: 'GameState'):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        with self._lock:
+            self.conn.execute('''
                 INSERT OR REPLACE INTO games 
                 (guild_id, channel_id, game_active, hammer_active, hammer_end_time, last_update_time)
                 VALUES (?, ?, ?, ?, ?, ?)
@@ -213,12 +202,10 @@ class Database:
                 game.hammer_end_time.isoformat() if game.hammer_end_time else None,
                 game.last_update_time.isoformat() if game.last_update_time else None
             ))
-            conn.commit()
 
     def update_hammer(self, guild_id: int, hammer_active: bool, end_time: Optional[datetime], last_update: Optional[datetime]):
-         with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        with self._lock:
+            self.conn.execute('''
                 UPDATE games 
                 SET hammer_active = ?, hammer_end_time = ?, last_update_time = ?
                 WHERE guild_id = ?
@@ -228,84 +215,146 @@ class Database:
                 last_update.isoformat() if last_update else None,
                 guild_id
             ))
-            conn.commit()
+
+    def touch_last_update(self, guild_id: int, last_update: datetime):
+        with self._lock:
+            self.conn.execute(
+                'UPDATE games SET last_update_time = ? WHERE guild_id = ?',
+                (last_update.isoformat(), guild_id)
+            )
 
     def save_vote(self, guild_id: int, voter_id: int, target_id: int):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO votes (guild_id, voter_id, target_id)
-                VALUES (?, ?, ?)
-            ''', (guild_id, voter_id, target_id))
-            conn.commit()
+        """Buffer a vote; it is written on the next flush. Must be called from the event loop."""
+        self.pending_votes[(guild_id, voter_id)] = target_id
+        self._flush_soon()
 
     def remove_vote(self, guild_id: int, voter_id: int):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM votes WHERE guild_id = ? AND voter_id = ?', (guild_id, voter_id))
-            conn.commit()
+        """Buffer a vote removal; it is written on the next flush. Must be called from the event loop."""
+        self.pending_votes[(guild_id, voter_id)] = None
+        self._flush_soon()
+
+    def _flush_soon(self):
+        if self._flush_handle is None and not self._closed:
+            self._flush_handle = asyncio.get_running_loop().call_later(VOTE_FLUSH_DELAY, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.create_task(self.flush_votes())
+
+    def _get_flush_lock(self) -> asyncio.Lock:
+        # Created on first use so it belongs to the running loop, not the import-time one
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def flush_votes(self):
+        """Write all buffered vote changes in one transaction off the event loop."""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # The lock keeps flushes in order, so an older batch never lands after a newer one
+        async with self._get_flush_lock():
+            pending, self.pending_votes = self.pending_votes, {}
+            if not pending:
+                return
+            try:
+                await asyncio.to_thread(self._write_votes, pending)
+            except Exception as e:
+                print(f"Vote flush error (re-queueing {len(pending)} change(s)): {e}")
+                # Put the batch back without clobbering changes buffered since the swap
+                for key, target_id in pending.items():
+                    self.pending_votes.setdefault(key, target_id)
+                self._flush_soon()
+
+    @asynccontextmanager
+    async def purging_votes(self, guild_id: int, player_id: Optional[int] = None):
+        """Hold off vote flushes while the caller deletes votes from the DB.
+
+        Buffered changes the purge would delete are discarded rather than written,
+        so they can't land after it. With player_id, only votes from or for that
+        player are dropped; otherwise every buffered vote in the guild is.
+        """
+        # Waiting on the lock also lets an in-flight flush (and any re-queue) finish first
+        async with self._get_flush_lock():
+            if player_id is None:
+                stale = [key for key in self.pending_votes if key[0] == guild_id]
+            else:
+                stale = [(g, voter_id) for (g, voter_id), target_id in self.pending_votes.items()
+                         if g == guild_id and (voter_id == player_id or target_id == player_id)]
+            for key in stale:
+                del self.pending_votes[key]
+            yield
+
+    def _write_votes(self, pending: dict[tuple[int, int], Optional[int]]):
+        upserts = [(guild_id, voter_id, target_id)
+                   for (guild_id, voter_id), target_id in pending.items() if target_id is not None]
+        deletes = [(guild_id, voter_id)
+                   for (guild_id, voter_id), target_id in pending.items() if target_id is None]
+        with self._transaction():
+            if upserts:
+                self.conn.executemany('''
+                    INSERT OR REPLACE INTO votes (guild_id, voter_id, target_id)
+                    VALUES (?, ?, ?)
+                ''', upserts)
+            if deletes:
+                self.conn.executemany('DELETE FROM votes WHERE guild_id = ? AND voter_id = ?', deletes)
 
     def clear_votes(self, guild_id: int):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM votes WHERE guild_id = ?', (guild_id,))
-            conn.commit()
-
-    def save_elimination(self, guild_id: int, player_id: int):
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        with self._lock:
+            self.conn.execute('DELETE FROM votes WHERE guild_id = ?', (guild_id,))
+
+    def eliminate_and_purge_votes(self, guild_id: int, player_id: int):
+        """Record an elimination and drop votes to/from the player in one transaction."""
+        with self._transaction():
+            self.conn.execute('''
                 INSERT OR IGNORE INTO eliminated (guild_id, player_id)
                 VALUES (?, ?)
             ''', (guild_id, player_id))
-            conn.commit()
+            self.conn.execute(
+                'DELETE FROM votes WHERE guild_id = ? AND (voter_id = ? OR target_id = ?)',
+                (guild_id, player_id, player_id)
+            )
 
     def delete_game(self, guild_id: int):
         """Used for full reset"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM games WHERE guild_id = ?', (guild_id,))
-            cursor.execute('DELETE FROM votes WHERE guild_id = ?', (guild_id,))
-            cursor.execute('DELETE FROM eliminated WHERE guild_id = ?', (guild_id,))
-            conn.commit()
+        with self._transaction('IMMEDIATE'):
+            self.conn.execute('DELETE FROM games WHERE guild_id = ?', (guild_id,))
+            self.conn.execute('DELETE FROM votes WHERE guild_id = ?', (guild_id,))
+            self.conn.execute('DELETE FROM eliminated WHERE guild_id = ?', (guild_id,))
     
     def load_state(self) -> dict[int, 'GameState']:
         games = {}
-        with self.get_connection() as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+        with self._lock:
+            cursor = self.conn.cursor()
             
             # Load games
-            cursor.execute('SELECT * FROM games')
-            for row in cursor.fetchall():
-                guild_id = row['guild_id']
+            cursor.execute(
+                'SELECT guild_id, channel_id, game_active, hammer_active, hammer_end_time, last_update_time FROM games'
+            )
+            for guild_id, channel_id, game_active, hammer_active, hammer_end_time, last_update_time in cursor.fetchall():
                 game = GameState(guild_id) # Pass guild_id to GameState
-                game.game_active = bool(row['game_active'])
-                game.hammer_active = bool(row['hammer_active'])
-                if row['hammer_end_time']:
-                    game.hammer_end_time = datetime.fromisoformat(row['hammer_end_time'])
-                if row['last_update_time']:
-                    game.last_update_time = datetime.fromisoformat(row['last_update_time'])
+                game.game_active = bool(game_active)
+                game.hammer_active = bool(hammer_active)
+                if hammer_end_time:
+                    game.hammer_end_time = datetime.fromisoformat(hammer_end_time)
+                    # Rebase the persisted wall-clock deadline onto this process's monotonic clock
+                    game.hammer_end_monotonic = time.monotonic() + (game.hammer_end_time - datetime.now()).total_seconds()
+                if last_update_time:
+                    game.last_update_time = datetime.fromisoformat(last_update_time)
                 
                 # Fetch channel object later in on_ready? 
                 # Ideally we store ID and fetch it when needed or in on_ready.
-                game.channel_id = row['channel_id']
+                game.channel_id = channel_id
                 
                 games[guild_id] = game
 
-            # Load votes
-            cursor.execute('SELECT * FROM votes')
-            for row in cursor.fetchall():
-                guild_id = row['guild_id']
-                if guild_id in games:
-                    games[guild_id].votes[row['voter_id']] = row['target_id']
-
-            # Load eliminations
-            cursor.execute('SELECT * FROM eliminated')
-            for row in cursor.fetchall():
-                 guild_id = row['guild_id']
-                 if guild_id in games:
-                     games[guild_id].eliminated_players.add(row['player_id'])
+            # Load votes and eliminations per guild (served by the primary key indexes)
+            for guild_id, game in games.items():
+                cursor.execute('SELECT voter_id, target_id FROM votes WHERE guild_id = ?', (guild_id,))
+                game.votes.update(cursor.fetchall())  # (voter_id, target_id) pairs
+
+                cursor.execute('SELECT player_id FROM eliminated WHERE guild_id = ?', (guild_id,))
+                game.eliminated_players.update(player_id for (player_id,) in cursor.fetchall())
         
         return games
 
@@ -319,7 +368,8 @@ class GameState:
         self.guild_id = guild_id
         self.votes: dict[int, int] = {}  # voter_id -> target_id
         self.hammer_active: bool = False
-        self.hammer_end_time: Optional[datetime] = None
+        self.hammer_end_time: Optional[datetime] = None  # Wall clock, persisted to the DB
+        self.hammer_end_monotonic: Optional[float] = None  # time.monotonic() deadline for expiry checks
         self.game_channel: Optional[discord.TextChannel] = None
         self.channel_id: Optional[int] = None # For restoration
         self.last_update_time: Optional[datetime] = None
@@ -330,25 +380,22 @@ class GameState:
     def get_active_players(self, guild: discord.Guild) -> list[discord.Member]:
         """Get all active players (have role and not eliminated)."""
         all_players = get_players_with_role(guild)
-        return [p for p in all_players if p.id not in self.eliminated_players]
+        eliminated = self.eliminated_players
+        if not eliminated:
+            return all_players  # Already a fresh list, nothing to filter
+        return [p for p in all_players if p.id not in eliminated]
 
-    def eliminate_player(self, member: discord.Member):
+    async def eliminate_player(self, member: discord.Member):
         """Mark a player as eliminated."""
         self.eliminated_players.add(member.id)
-        if self.guild_id:
-             db.save_elimination(self.guild_id, member.id)
-        
         # Remove any votes to/from this player
-        if member.id in self.votes:
-            if self.guild_id: db.remove_vote(self.guild_id, member.id)
-            del self.votes[member.id]
-            
-        # Remove votes casting ON this player
-        to_remove = [voter_id for voter_id, target_id in self.votes.items() if target_id == member.id]
-        for voter_id in to_remove:
-            if self.guild_id: db.remove_vote(self.guild_id, voter_id)
-            del self.votes[voter_id]
-            
+        self.votes = {k: v for k, v in self.votes.items()
+                      if k != member.id and v != member.id}
+        if self.guild_id:
+            async with db.purging_votes(self.guild_id, member.id):
+                if games.get(self.guild_id) is not self:
+                    return  # Game was reset while waiting; don't write into the new one
+                await asyncio.to_thread(db.eliminate_and_purge_votes, self.guild_id, member.id)
     
     def cast_vote(self, voter_id: int, target_id: int) -> bool:
         """Cast a vote. Returns True if successful."""
@@ -374,51 +421,78 @@ class GameState:
         for voter_id, target_id in self.votes.items():
             tally[target_id].append(voter_id)
         return dict(tally)
+
+    def get_vote_counts(self) -> Counter:
+        """Get vote counts per target. Returns Counter({target_id: count})"""
+        return Counter(self.votes.values())
     
     def get_majority_threshold(self, guild: discord.Guild) -> int:
         """Get the number of votes needed for majority."""
-        active_players = self.get_active_players(guild)
+        return self.get_majority_threshold_from(self.get_active_players(guild))
+
+    def get_majority_threshold_from(self, active_players: list[discord.Member]) -> int:
+        """Get the majority threshold from an already computed active player list."""
         return (len(active_players) // 2) + 1
     
-    def check_majority(self, guild: discord.Guild) -> Optional[int]:
+    def check_majority(self, guild: discord.Guild, active_players: Optional[list[discord.Member]] = None) -> Optional[int]:
         """Check if any player has majority votes. Returns player_id or None."""
-        threshold = self.get_majority_threshold(guild)
-        tally = self.get_vote_tally()
-        for target_id, voters in tally.items():
-            if len(voters) >= threshold:
+        if active_players is None:
+            active_players = self.get_active_players(guild)
+        threshold = self.get_majority_threshold_from(active_players)
+        for target_id, count in self.get_vote_counts().items():
+            if count >= threshold:
                 return target_id
         return None
 
-    def start_hammer(self, channel: discord.TextChannel):
+    async def start_hammer(self, channel: discord.TextChannel):
         """Start the hammer countdown."""
+        now = datetime.now()
         self.hammer_active = True
-        self.hammer_end_time = datetime.now() + HAMMER_DURATION
+        self.hammer_end_time = now + HAMMER_DURATION
+        self.hammer_end_monotonic = time.monotonic() + HAMMER_DURATION.total_seconds()
         self.game_channel = channel
-        self.last_update_time = datetime.now()
+        self.last_update_time = now
         if self.guild_id:
-            db.update_hammer(self.guild_id, True, self.hammer_end_time, self.last_update_time)
-            # Ensure game active state is saved too just in case
-            db.save_game(self.guild_id, self)
+            track_hammer(self)
+            # save_game's upsert carries the hammer fields along with game/channel state
+            await asyncio.to_thread(db.save_game, self.guild_id, self)
     
-    # ... (get_time_remaining, is_hammer_expired remain same)
-    def get_time_remaining(self) -> Optional[timedelta]:
+    # ... (get_time_remaining remains same)
+    def get_time_remaining(self, now: Optional[datetime] = None) -> Optional[timedelta]:
         """Get time remaining in hammer countdown."""
         if not self.hammer_active or not self.hammer_end_time:
             return None
-        remaining = self.hammer_end_time - datetime.now()
+        remaining = self.hammer_end_time - (now or datetime.now())
         if remaining.total_seconds() < 0:
             return timedelta(0)
         return remaining
-    
-    def is_hammer_expired(self) -> bool:
-        """Check if the hammer countdown has expired."""
-        remaining = self.get_time_remaining()
-        return remaining is not None and remaining.total_seconds() <= 0
 
 
 # Store game states per guild
 games: dict[int, GameState] = {}
 
+# Per-guild hammer timers for the minute loop, kept apart from GameState so the loop
+# only touches these three dicts. A guild is in hammer_end only while its hammer runs.
+hammer_end: dict[int, float] = {}  # guild_id -> time.monotonic() deadline
+last_update: dict[int, float] = {}  # guild_id -> time.monotonic() of the last posted update
+channel_ref: dict[int, discord.TextChannel] = {}  # guild_id -> channel to post updates in
+
+
+def track_hammer(game: GameState):
+    """Register a running hammer with the minute loop."""
+    hammer_end[game.guild_id] = game.hammer_end_monotonic
+    if game.last_update_time:
+        last_update[game.guild_id] = time.monotonic() - (datetime.now() - game.last_update_time).total_seconds()
+    if game.game_channel:
+        channel_ref[game.guild_id] = game.game_channel
+
+
+def untrack_hammer(guild_id: int):
+    """Remove a guild's hammer from the minute loop."""
+    hammer_end.pop(guild_id, None)
+    last_update.pop(guild_id, None)
+    channel_ref.pop(guild_id, None)
+
 
 def get_game(guild_id: int) -> GameState:
     """Get or create a game state for a guild."""
@@ -427,38 +501,35 @@ def get_game(guild_id: int) -> GameState:
     return games[guild_id]
 
 # ... (format_tally, format_time_remaining, etc. remain the same)
-def format_tally(game: GameState, guild: discord.Guild) -> str:
+def format_tally(game: GameState, guild: discord.Guild, active_players: Optional[list[discord.Member]] = None) -> str:
     """Format the current vote tally as a string."""
-    active_players = game.get_active_players(guild)
+    if active_players is None:
+        active_players = game.get_active_players(guild)
     tally = game.get_vote_tally()
     
     if not tally:
         return "📊 **Vote Tally**\n\nNo votes cast yet."
     
     lines = ["📊 **Vote Tally**\n"]
-    threshold = game.get_majority_threshold(guild)
+    threshold = game.get_majority_threshold_from(active_players)
     lines.append(f"*Majority to hammer: {threshold} votes (of {len(active_players)} players)*\n")
     
     # Sort by vote count descending
     sorted_tally = sorted(tally.items(), key=lambda x: len(x[1]), reverse=True)
     
+    get_member = guild.get_member
     for target_id, voter_ids in sorted_tally:
-        target = guild.get_member(target_id)
+        target = get_member(target_id)
         target_name = target.display_name if target else f"Unknown ({target_id})"
-        vote_count = len(voter_ids)
         
         # Get voter names
-        voter_names = []
-        for vid in voter_ids:
-            voter = guild.get_member(vid)
-            voter_names.append(voter.display_name if voter else f"Unknown")
+        voter_names = [voter.display_name if (voter := get_member(vid)) else "Unknown" for vid in voter_ids]
         
         voters_str = ", ".join(voter_names)
-        lines.append(f"**{target_name}** ({vote_count}): {voters_str}")
+        lines.append(f"**{target_name}** ({len(voter_ids)}): {voters_str}")
     
     # Show players with no votes
-    players_with_votes = set(tally.keys())
-    no_votes = [p for p in active_players if p.id not in players_with_votes]
+    no_votes = [p for p in active_players if p.id not in tally]
     if no_votes:
         no_vote_names = ", ".join(p.display_name for p in no_votes)
         lines.append(f"\n*No votes: {no_vote_names}*")
@@ -481,21 +552,18 @@ def format_time_remaining(td: timedelta) -> str:
 
 
 # Check permissions logic
+# Permission bits that count as manager/mod. Currently administrator only; to allow
+# other mod-like permissions, add e.g. manage_guild=True, kick_members=True,
+# ban_members=True, manage_roles=True here.
+MOD_MASK = discord.Permissions(administrator=True).value
+
+
 def is_manager_or_mod(interaction: discord.Interaction) -> bool:
     """Check if the user has manager or moderator permissions."""
     if not isinstance(interaction.user, discord.Member):
         return False
-    
-    # Check for direct administrator permission
-    if interaction.user.guild_permissions.administrator:
-        return True
-    return False    
-    # Check for other mod-like permissions
-    # perms = interaction.user.guild_permissions
-    # return (perms.manage_guild or 
-    #         perms.kick_members or 
-    #         perms.ban_members or 
-    #         perms.manage_roles)
+    return bool(interaction.user.guild_permissions.value & MOD_MASK)
+
 
 async def vote_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
     """Autocomplete for vote command showing active players except self."""
@@ -591,14 +659,15 @@ async def vote(interaction: discord.Interaction, player_id: str):
 
     # Cast the vote
     game.cast_vote(voter.id, target.id)
-    tally = format_tally(game, interaction.guild)
+    active_players = game.get_active_players(interaction.guild)
+    tally = format_tally(game, interaction.guild, active_players)
     
     # Check for majority
-    majority_player_id = game.check_majority(interaction.guild)
+    majority_player_id = game.check_majority(interaction.guild, active_players)
     
     if majority_player_id and not game.hammer_active:
         majority_player = interaction.guild.get_member(majority_player_id)
-        game.start_hammer(interaction.channel)
+        await game.start_hammer(interaction.channel)
         
         await interaction.response.send_message(
             f"🗳️ **{voter.display_name}** voted for **{target.display_name}**\n\n"
@@ -703,7 +772,7 @@ async def hammer(interaction: discord.Interaction):
         )
         return
     
-    game.start_hammer(interaction.channel)
+    await game.start_hammer(interaction.channel)
     tally = format_tally(game, interaction.guild)
     
     await interaction.response.send_message(
@@ -784,7 +853,7 @@ async def players(interaction: discord.Interaction):
         message += f"\n\n💀 **Eliminated:**\n{eliminated_list}"
     
     if game.game_active:
-        message += f"\n\n*Majority threshold: {game.get_majority_threshold(interaction.guild)} votes*"
+        message += f"\n\n*Majority threshold: {game.get_majority_threshold_from(active_players)} votes*"
     else:
         message += f"\n\n*Game not started. Use `/startgame` to begin.*"
     
@@ -857,23 +926,26 @@ async def startgame(interaction: discord.Interaction):
         )
         return
 
-    # Reset game state
-    db.delete_game(interaction.guild.id) # Clear old DB data
-    
+    # Reset game state. Swap in the new (still inactive) game before awaiting so
+    # votes arriving meanwhile are rejected instead of landing in the old game.
     games[interaction.guild.id] = GameState(interaction.guild.id)
     game = games[interaction.guild.id]
+    untrack_hammer(interaction.guild.id)
+    async with db.purging_votes(interaction.guild.id):
+        await asyncio.to_thread(db.delete_game, interaction.guild.id) # Clear old DB data
+    
     game.game_active = True
     game.game_channel = interaction.channel
     
     # Save initial state
-    db.save_game(interaction.guild.id, game)
+    await asyncio.to_thread(db.save_game, interaction.guild.id, game)
     
     player_list = "\n".join(f"• {p.display_name}" for p in players)
     
     await interaction.response.send_message(
         f"🎮 **MAFIA GAME STARTED!**\n\n"
         f"👥 **Players ({len(players)}):**\n{player_list}\n\n"
-        f"*Majority to hammer: {game.get_majority_threshold(interaction.guild)} votes*\n\n"
+        f"*Majority to hammer: {game.get_majority_threshold_from(players)} votes*\n\n"
         f"Use `/vote` to vote for a player!\n"
         f"Use `/unvote` to remove your vote.\n"
         f"Use `/tally` to see the current standings."
@@ -947,13 +1019,13 @@ async def eliminate(interaction: discord.Interaction, player_id: str):
         )
         return
     
-    game.eliminate_player(player) # Handles DB save
+    await game.eliminate_player(player) # Handles DB save
     active_players = game.get_active_players(interaction.guild)
     
     await interaction.response.send_message(
         f"💀 **{player.display_name}** has been eliminated!\n\n"
         f"*Remaining players: {len(active_players)}*\n"
-        f"*New majority threshold: {game.get_majority_threshold(interaction.guild)} votes*"
+        f"*New majority threshold: {game.get_majority_threshold_from(active_players)} votes*"
     )
 
 @bot.tree.command(name="setrole", description="Set the player role name (Managers/Mods only)")
@@ -968,7 +1040,7 @@ async def setrole(interaction: discord.Interaction, role_name: str):
         )
         return
 
-    global PLAYER_ROLE_NAME
+    global PLAYER_ROLE_NAME, PLAYER_ROLE_NAME_LOWER
     
     # Check if the role exists
     role_found = None
@@ -985,6 +1057,8 @@ async def setrole(interaction: discord.Interaction, role_name: str):
         )
     else:
         PLAYER_ROLE_NAME = role_name
+        PLAYER_ROLE_NAME_LOWER = role_name.lower()
+        _role_cache.clear()
         players = get_players_with_role(interaction.guild)
         await interaction.response.send_message(
             f"✅ Player role set to **{role_name}**!\n"
@@ -1011,7 +1085,9 @@ async def resetgame(interaction: discord.Interaction):
         return
     
     games[interaction.guild.id] = GameState(interaction.guild.id)
-    db.delete_game(interaction.guild.id) # Clear DB
+    untrack_hammer(interaction.guild.id)
+    async with db.purging_votes(interaction.guild.id):
+        await asyncio.to_thread(db.delete_game, interaction.guild.id) # Clear DB
     
     await interaction.response.send_message(
         "🔄 Game has been reset! All votes and eliminations cleared.\n"
@@ -1042,10 +1118,13 @@ async def resetvotes(interaction: discord.Interaction):
     game.votes.clear()
     game.hammer_active = False
     game.hammer_end_time = None
+    game.hammer_end_monotonic = None
     game.last_update_time = None
+    untrack_hammer(interaction.guild.id)
     
-    db.clear_votes(interaction.guild.id)
-    db.update_hammer(interaction.guild.id, False, None, None)
+    async with db.purging_votes(interaction.guild.id):
+        await asyncio.to_thread(db.clear_votes, interaction.guild.id)
+    await asyncio.to_thread(db.update_hammer, interaction.guild.id, False, None, None)
     
     active_players = game.get_active_players(interaction.guild)
     player_list = ", ".join(p.display_name for p in active_players)
@@ -1053,7 +1132,7 @@ async def resetvotes(interaction: discord.Interaction):
     await interaction.response.send_message(
         f"🔄 All votes have been reset!\n\n"
         f"**Active players ({len(active_players)}):** {player_list}\n"
-        f"*Majority threshold: {game.get_majority_threshold(interaction.guild)} votes*"
+        f"*Majority threshold: {game.get_majority_threshold_from(active_players)} votes*"
     )
 
 
@@ -1061,48 +1140,54 @@ async def resetvotes(interaction: discord.Interaction):
 @tasks.loop(minutes=1)
 async def check_hammer_countdown():
     """Check all games for hammer countdown updates and expiration."""
-    for guild_id, game in games.items():
-        if not game.hammer_active:
-            continue
-            
-        # If we just loaded from DB, we might need to fetch the channel object
-        if not game.game_channel and game.channel_id:
-             guild = bot.get_guild(guild_id)
-             if guild:
-                 game.game_channel = guild.get_channel(game.channel_id)
-
-        if not game.game_channel:
-             continue
-        
-        now = datetime.now()
-        remaining = game.get_time_remaining()
-        
-        if remaining is None:
+    now_mono = time.monotonic()
+    update_interval = HAMMER_UPDATE_INTERVAL.total_seconds()
+    for guild_id in list(hammer_end):
+        # A command may have cleared this hammer while an earlier guild was awaiting
+        end = hammer_end.get(guild_id)
+        if end is None:
             continue
+        channel = channel_ref.get(guild_id)
+        if not channel:
+            # The guild or channel wasn't available in on_ready; retry the lookup
+            game = games.get(guild_id)
+            guild = bot.get_guild(guild_id)
+            if game and guild and game.channel_id:
+                channel = guild.get_channel(game.channel_id)
+            if not channel:
+                continue
+            game.game_channel = channel
+            channel_ref[guild_id] = channel
         
         # Check if expired
-        if game.is_hammer_expired():
+        if now_mono >= end:
+            game = games.get(guild_id)
+            untrack_hammer(guild_id)
+            if not game:
+                continue
             game.hammer_active = False
-            db.update_hammer(guild_id, False, None, None) # Update DB
+            await asyncio.to_thread(db.update_hammer, guild_id, False, None, None) # Update DB
+            if games.get(guild_id) is not game:
+                continue  # Game was reset while we were writing
             
             guild = bot.get_guild(guild_id)
             if guild:
                 tally = format_tally(game, guild)
                 
                 # Find who was hammered (player with most votes)
-                vote_tally = game.get_vote_tally()
-                if vote_tally:
-                    hammered_id = max(vote_tally.keys(), key=lambda k: len(vote_tally[k]))
+                vote_counts = game.get_vote_counts()
+                if vote_counts:
+                    hammered_id = vote_counts.most_common(1)[0][0]
                     hammered = guild.get_member(hammered_id)
                     hammered_name = hammered.display_name if hammered else "Unknown"
                     
                     # Auto-eliminate the hammered player
                     if hammered:
-                        game.eliminate_player(hammered) # Handles DB save
+                        await game.eliminate_player(hammered) # Handles DB save
                 else:
                     hammered_name = "No one (no votes)"
                 
-                await game.game_channel.send(
+                await channel.send(
                     f"⏰ **TIME'S UP!**\n\n"
                     f"🔨 **{hammered_name}** has been eliminated!\n\n"
                     f"**Final Tally:**\n{tally}"
@@ -1110,20 +1195,27 @@ async def check_hammer_countdown():
             continue
         
         # Check if we should post an update (every 4 hours)
-        if game.last_update_time:
-            time_since_update = now - game.last_update_time
-            if time_since_update >= timedelta(hours=4):
-                game.last_update_time = now
-                db.update_hammer(guild_id, True, game.hammer_end_time, now) # DB Update
-                
-                guild = bot.get_guild(guild_id)
-                if guild:
-                    tally = format_tally(game, guild)
-                    await game.game_channel.send(
-                        f"⏰ **Hammer Update**\n\n"
-                        f"Time remaining: **{format_time_remaining(remaining)}**\n\n"
-                        f"{tally}"
-                    )
+        last = last_update.get(guild_id)
+        if last is not None and now_mono - last >= update_interval:
+            game = games.get(guild_id)
+            if not game:
+                untrack_hammer(guild_id)
+                continue
+            now = datetime.now()
+            last_update[guild_id] = now_mono
+            game.last_update_time = now
+            await asyncio.to_thread(db.touch_last_update, guild_id, now) # DB Update
+            if games.get(guild_id) is not game:
+                continue  # Game was reset while we were writing
+            
+            guild = bot.get_guild(guild_id)
+            if guild:
+                tally = format_tally(game, guild)
+                await channel.send(
+                    f"⏰ **Hammer Update**\n\n"
+                    f"Time remaining: **{format_time_remaining(game.get_time_remaining(now))}**\n\n"
+                    f"{tally}"
+                )
 
 
 @bot.event
@@ -1136,7 +1228,21 @@ async def on_ready():
     # Load state from DB
     global games
     print("Loading game state from database...")
-    games = db.load_state()
+    # on_ready also fires after reconnects; land buffered votes before reloading
+    await db.flush_votes()
+    games = await asyncio.to_thread(db.load_state)
+    hammer_end.clear()
+    last_update.clear()
+    channel_ref.clear()
+
+    # Resolve restored channel ids once so the hammer loop never has to
+    for gid, game in games.items():
+        guild = bot.get_guild(gid)
+        if guild and game.channel_id:
+            game.game_channel = guild.get_channel(game.channel_id)
+        if game.hammer_active and game.hammer_end_monotonic is not None:
+            track_hammer(game)
+
     print(f"Loaded {len(games)} active games.")
 
     if ALLOWED_CATEGORY_ID:
@@ -1159,6 +1265,17 @@ async def on_ready():
         check_hammer_countdown.start()
 
 
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    """Drop the cached player role when a role is renamed or edited."""
+    _role_cache.pop(after.guild.id, None)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    """Drop the cached player role when a role is deleted."""
+    _role_cache.pop(role.guild.id, None)
+
 
 if __name__ == '__main__':
     if not TOKEN: